@@ -1,12 +1,17 @@
 import logging
 import os
+import threading
 
+import cv2
 import easyocr
 import numpy as np
+import orjson
+import torch
 import yaml
+from symspellpy import SymSpell, Verbosity
 
 # Define the set of valid tags
-TAGS = {
+TAGS: frozenset[str] = frozenset({
     '火屬性', '水屬性', '風屬性', '光屬性', '闇屬性',
     '攻擊者', '守護者', '治療者', '妨礙者', '輔助者',
     '人類', '魔族', '亞人',
@@ -15,7 +20,37 @@ TAGS = {
     '士兵', '菁英', '領袖',
     '輸出', '保護', '防禦', '回復', '干擾', '支援',
     '削弱', '爆發力', '生存力', '越戰越強', '群體攻擊', '回擊'
-}
+})
+
+# Define the minimum normalized similarity for correcting a misread word to the closest tag
+FUZZY_MATCH_CUTOFF = 0.66
+
+# Define the maximum edit distance for looking up the closest tag
+FUZZY_MATCH_MAX_DISTANCE = 2
+
+# Define the number of tags shown on the recruitment page
+TAGS_PER_SCREENSHOT = 5
+
+# Define the vertical range of the tags region in a full screenshot, as ratios of the image height
+TAGS_REGION = (0.25, 0.6)
+
+# Define the width that images are resized to for template matching, as the game interface scales with the screen width
+TEMPLATE_WIDTH = 720
+
+# Define the minimum normalized correlation coefficient for a tag template to match
+TEMPLATE_MATCH_THRESHOLD = 0.9
+
+# Define the minimum margin by which a matching template must outscore other templates at the same location
+TEMPLATE_MATCH_MARGIN = 0.1
+
+# Define the number of threads used by PyTorch, which can be overridden by a positive integer in `OMP_NUM_THREADS`,
+# so that OCR does not oversubscribe the CPU shared with the event loop and the browser
+_omp_num_threads = os.getenv('OMP_NUM_THREADS', '').strip()
+TORCH_NUM_THREADS = (
+    int(_omp_num_threads) if _omp_num_threads.isdigit() and int(_omp_num_threads) > 0
+    else min(4, os.cpu_count() or 1)
+)
+TORCH_NUM_INTEROP_THREADS = min(2, TORCH_NUM_THREADS)
 
 # Define the template for the YAML file containing word mappings for correcting OCR misread words
 YAML_TEMPLATE = """\
@@ -35,14 +70,69 @@ YAML_TEMPLATE = """\
 # Initialize a logger for this module
 logger = logging.getLogger(__name__)
 
-# Initialize the EasyOCR reader
-reader = easyocr.Reader(['ch_tra'])
+
+def build_tag_index() -> SymSpell:
+    """
+    Build a SymSpell index of the tags, so that looking up the closest tag does not scan all tags.
+
+    :return: The SymSpell instance containing every tag.
+    """
+    tag_index = SymSpell(max_dictionary_edit_distance=FUZZY_MATCH_MAX_DISTANCE, prefix_length=7)
+    for tag in TAGS:
+        tag_index.create_dictionary_entry(tag, 1)
+
+    return tag_index
+
+
+# Index the tags once at import, as every OCR result is looked up in it
+sym_spell = build_tag_index()
+
+# Use the LibYAML-based loader if available, as it is much faster than the pure Python one
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Cache the contents of loaded YAML files, keyed by file path, along with their modification times and sizes
+_yaml_cache: dict[str, tuple[list[int], dict]] = {}
+
+# Cache the grayscale templates of the tags, keyed by tag, learned from images whose tags were extracted by OCR
+_tag_templates: dict[str, np.ndarray] = {}
+
+# Limit the threads used by PyTorch once at import, before it starts any parallel work,
+# as the number of inter-op threads cannot be changed afterwards
+torch.set_num_threads(TORCH_NUM_THREADS)
+torch.set_num_interop_threads(TORCH_NUM_INTEROP_THREADS)
+
+# The EasyOCR reader is loaded lazily on first use, as loading the model is slow
+_reader: easyocr.Reader | None = None
+_reader_lock = threading.Lock()
+
+
+def get_reader() -> easyocr.Reader:
+    """
+    Return the shared EasyOCR reader, loading the model on the first call.
+
+    :return: The EasyOCR reader instance.
+    """
+    global _reader
+
+    if _reader is None:
+        with _reader_lock:
+            # Check again in case another thread loaded the model while waiting for the lock
+            if _reader is None:
+                logger.info("Loading EasyOCR model")
+                # Use dynamic INT8 quantization for faster inference on CPU
+                _reader = easyocr.Reader(['ch_tra'], quantize=True, cudnn_benchmark=False)
+                logger.info("EasyOCR model loaded")
+
+    return _reader
 
 
 def yaml_to_dict(file_path: str) -> dict:
     """
     Load a YAML file and return its contents as a dictionary.
     If the file does not exist, create it using the predefined template.
+    The contents are cached and only reloaded when the file is modified.
+    A JSON copy of the contents is kept next to the YAML file, which is loaded instead if it was written from the
+    current version of the YAML file.
 
     :param file_path: The path to the YAML file.
     :return: A dictionary containing the YAML file contents.
@@ -60,58 +150,292 @@ def yaml_to_dict(file_path: str) -> dict:
                 f.write(YAML_TEMPLATE)
                 logger.info(f'File created: "{file_path}"')
 
-        # Load the YAML file and return its contents as a dictionary
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f) or {}
+        # Identify the version of the YAML file by its modification time and size
+        stat = os.stat(file_path)
+        source = [stat.st_mtime_ns, stat.st_size]
+
+        # Return the cached contents if the file has not been modified since it was last loaded
+        cached = _yaml_cache.get(file_path)
+        if cached is not None and cached[0] == source:
+            return cached[1]
+
+        # Load the JSON copy if it was written from this exact version of the YAML file,
+        # as parsing JSON is much faster than parsing YAML
+        json_path = os.path.splitext(file_path)[0] + '.json'
+        contents = None
+        if os.path.isfile(json_path):
+            try:
+                with open(json_path, 'rb') as f:
+                    json_copy = orjson.loads(f.read())
+                if json_copy.get('source') == source:
+                    contents = json_copy['contents']
+                    logger.info(f'File loaded: "{json_path}"')
+            except Exception as e:
+                logger.warning(f"An exception caught while loading the JSON file: {e}")
+
+        if contents is None:
+            # Load the YAML file and return its contents as a dictionary
+            with open(file_path, 'r', encoding='utf-8') as f:
+                contents = yaml.load(f, Loader=YamlLoader) or {}
+                logger.info(f'File loaded: "{file_path}"')
+
+            # Write the JSON copy atomically, so that a partially written file is never loaded
+            try:
+                with open(json_path + '.tmp', 'wb') as f:
+                    f.write(orjson.dumps({'source': source, 'contents': contents}, option=orjson.OPT_NON_STR_KEYS))
+                os.replace(json_path + '.tmp', json_path)
+                logger.info(f'File created: "{json_path}"')
+            except Exception as e:
+                logger.warning(f"An exception caught while writing the JSON file: {e}")
+
+        _yaml_cache[file_path] = (source, contents)
+        return contents
 
     except Exception as e:
         logger.warning(f"An exception caught while loading the YAML file: {e}")
         return {}
 
 
-def img_to_tags(image_arr: np.ndarray) -> list:
+def closest_tag(word: str) -> str:
+    """
+    Find the tag closest to a word using the Damerau-Levenshtein distance.
+
+    :param word: The word to match.
+    :return: The closest tag if it is unique and similar enough, otherwise the word itself.
+    """
+    suggestions = sym_spell.lookup(word, Verbosity.CLOSEST, max_edit_distance=FUZZY_MATCH_MAX_DISTANCE)
+
+    # Leave the word unchanged if no tag or several equally close tags are found, e.g., '暗屬性' for any 'X屬性' tag,
+    # as guessing would make the query run with a wrong tag instead of reporting the failed extraction
+    if len(suggestions) != 1:
+        return word
+
+    # Normalize the distance by the length of the longer string, so that short words are not over-corrected
+    suggestion = suggestions[0]
+    similarity = 1 - suggestion.distance / max(len(word), len(suggestion.term))
+    return suggestion.term if similarity >= FUZZY_MATCH_CUTOFF else word
+
+
+def crop_tags_region(image_arr: np.ndarray) -> np.ndarray:
     """
-    Extract tags from an image using OCR.
+    Crop a full screenshot to the region where the recruitment tags are located.
 
     :param image_arr: The input image as a numpy array.
-    :return: A list of valid tags found in the image.
+    :return: A view of the input image containing only the tags region.
     """
-    logger.info("Starting OCR process")
+    height = image_arr.shape[0]
+    top, bottom = (int(height * ratio) for ratio in TAGS_REGION)
+    return image_arr[top:bottom]
 
-    # Perform OCR on the image
-    results: list[tuple[list, str, float]] = reader.readtext(image_arr)
+
+def results_to_tag_boxes(results: list[tuple[list, str, float]]) -> list[tuple[list, str, str]]:
+    """
+    Extract tags from the OCR results of an image.
+
+    :param results: The OCR results as returned by EasyOCR.
+    :return: A list of valid tags found in the OCR results, each preceded by its bounding box and recognized word.
+    """
     logger.debug(f"OCR raw results: {results}")
 
-    # Extract the recognized words from the OCR results
-    result_words = [result[1] for result in results]
+    # Extract the recognized words in a single pass, limiting the scope for filtering tags
+    # to the 8 words starting from the reference word '招募條件'
+    # E.g., ['招募條件', '最多選擇三項', '中體型', '風屬性', '土兵', '亞人', '防禦', '本日剩餘更換2次']
+    boxes, raw_words = [], []
+    for box, word, _ in results:
+        if raw_words or word == '招募條件':
+            boxes.append(box)
+            raw_words.append(word)
+            if len(raw_words) == 8:
+                break
 
-    # Find the index of the reference word '招募條件'
-    try:
-        ref_word_idx = result_words.index('招募條件')
-    except ValueError:
+    if not raw_words:
         logger.warning("'招募條件' not found in the OCR results")
         return []  # Return an empty list if '招募條件' is not found
 
-    # Limit the scope for filtering tags
-    # E.g., ['招募條件', '最多選擇三項', '中體型', '風屬性', '土兵', '亞人', '防禦', '本日剩餘更換2次']
-    result_words = result_words[ref_word_idx:ref_word_idx + 8]
-    logger.debug(f"Words in scope for tag extraction: {result_words}")
+    logger.debug(f"Words in scope for tag extraction: {raw_words}")
 
     # Load the word mapping dictionary
     word_mappings = yaml_to_dict("./data/word_mappings.yaml")
     logger.debug(f"Loaded word mappings from 'word_mappings.yaml': {word_mappings}")
 
     # Replace similar words using the mapping dictionary
-    result_words = [word_mappings.get(word, word) for word in result_words]
-    logger.debug(f"Words after applying word mappings: {result_words}")
+    mapped_words = [word_mappings.get(word, word) for word in raw_words]
+    logger.debug(f"Words after applying word mappings: {mapped_words}")
+
+    # Correct the remaining misread words to the closest tags
+    corrected_words = [closest_tag(word) for word in mapped_words]
+    logger.debug(f"Words after fuzzy matching: {corrected_words}")
 
-    # Find valid tags by filtering recognized words that are in predefined tags
-    tags = [word for word in result_words if word in TAGS]
-    logger.info(f"Extracted tags: {tags}")
+    # Find valid tags by filtering corrected words that are in predefined tags,
+    # keeping the raw words so that callers can tell exact reads from corrected ones
+    tag_boxes = [
+        (box, raw_word, word)
+        for box, raw_word, word in zip(boxes, raw_words, corrected_words) if word in TAGS
+    ]
+    logger.info(f"Extracted tags: {[tag for _, _, tag in tag_boxes]}")
+
+    return tag_boxes
+
+
+def to_template_scale(image_arr: np.ndarray) -> tuple[np.ndarray, float]:
+    """
+    Convert an image to grayscale and resize it to the width used for template matching.
+
+    :param image_arr: The input image as a numpy array.
+    :return: The converted image and the scale factor applied to it.
+    """
+    scale = TEMPLATE_WIDTH / image_arr.shape[1]
+    grey = cv2.cvtColor(image_arr[:, :, :3], cv2.COLOR_RGB2GRAY)
+    grey = cv2.resize(grey, (TEMPLATE_WIDTH, max(1, round(grey.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+    return grey, scale
+
+
+def learn_templates(region: np.ndarray, tag_boxes: list[tuple[list, str, str]]):
+    """
+    Store the tags cropped from the tags region as templates for tags that do not have one yet.
+    Only tags recognized exactly by OCR are learned, as a wrongly corrected word would never be corrected again.
+
+    :param region: The tags region of a full screenshot as a numpy array.
+    :param tag_boxes: The tags extracted from the region by OCR, each preceded by its bounding box and recognized word.
+    """
+    grey, scale = to_template_scale(region)
+
+    for box, recognized_word, tag in tag_boxes:
+        if recognized_word != tag or tag in _tag_templates:
+            continue
+
+        xs, ys = [point[0] for point in box], [point[1] for point in box]
+        template = grey[int(min(ys) * scale):int(max(ys) * scale) + 1, int(min(xs) * scale):int(max(xs) * scale) + 1]
+        if template.size:
+            _tag_templates[tag] = template.copy()
+            logger.info(f"Learned template for tag: {tag}")
+
+
+def match_tags(region: np.ndarray) -> list | None:
+    """
+    Extract tags from the tags region of an image by matching it against the learned tag templates.
+
+    :param region: The tags region of a full screenshot as a numpy array.
+    :return: A list of tags in reading order if exactly the expected number of tags match, otherwise None.
+    """
+    if len(_tag_templates) < TAGS_PER_SCREENSHOT:
+        return None
+
+    grey, _ = to_template_scale(region)
+
+    # Find the best match location of each template, keeping close runners-up as candidates
+    candidates = []
+    for tag, template in list(_tag_templates.items()):
+        if template.shape[0] > grey.shape[0] or template.shape[1] > grey.shape[1]:
+            continue
+
+        _, score, _, (x, y) = cv2.minMaxLoc(cv2.matchTemplate(grey, template, cv2.TM_CCOEFF_NORMED))
+        if score >= TEMPLATE_MATCH_THRESHOLD - TEMPLATE_MATCH_MARGIN:
+            candidates.append((y, x, template.shape[0], template.shape[1], score, tag))
+
+    logger.debug(f"Template match candidates: {candidates}")
+    matches = [(y, x, height, tag) for y, x, height, _, score, tag in candidates if score >= TEMPLATE_MATCH_THRESHOLD]
+    if len(matches) != TAGS_PER_SCREENSHOT:
+        return None
+
+    # Treat the matches as ambiguous if any candidates overlap, i.e., several tags match the same location
+    for i, (y1, x1, height1, width1, _, _) in enumerate(candidates):
+        for y2, x2, height2, width2, _, _ in candidates[i + 1:]:
+            if x1 < x2 + width2 and x2 < x1 + width1 and y1 < y2 + height2 and y2 < y1 + height1:
+                logger.info("Ambiguous template matches, falling back to OCR")
+                return None
+
+    # Order the tags row by row, treating matches within half a template height of a row's first match as one row
+    rows = []
+    for y, x, height, tag in sorted(matches):
+        if rows and y - rows[-1][0][0] < height / 2:
+            rows[-1].append((y, x, height, tag))
+        else:
+            rows.append([(y, x, height, tag)])
+
+    tags = [tag for row in rows for _, _, _, tag in sorted(row, key=lambda match: match[1])]
+    logger.info(f"Extracted tags by template matching: {tags}")
 
     return tags
 
 
+def ocr_results_to_tags(image_arr: np.ndarray, region_results: list[tuple[list, str, float]]) -> list:
+    """
+    Extract tags from the OCR results of the tags region of an image,
+    falling back to OCR on the whole image if the tags are not found in the region.
+
+    :param image_arr: The input image as a numpy array.
+    :param region_results: The OCR results of the tags region of the image.
+    :return: A list of valid tags found in the image.
+    """
+    tag_boxes = results_to_tag_boxes(region_results)
+
+    if len(tag_boxes) == TAGS_PER_SCREENSHOT:
+        # Learn templates from full screenshots only, as the scale of cropped screenshots is unknown
+        learn_templates(crop_tags_region(image_arr), tag_boxes)
+    elif len(tag_boxes) < TAGS_PER_SCREENSHOT:
+        # Fall back to the whole image, e.g., for screenshots that have been cropped by the user
+        logger.info("Tags not found in the tags region, retrying OCR with the whole image")
+        tag_boxes = results_to_tag_boxes(get_reader().readtext(image_arr))
+
+    return [tag for _, _, tag in tag_boxes]
+
+
+def img_to_tags(image_arr: np.ndarray) -> list:
+    """
+    Extract tags from an image using template matching, or OCR if the tags cannot be matched.
+
+    :param image_arr: The input image as a numpy array.
+    :return: A list of valid tags found in the image.
+    """
+    return imgs_to_tags([image_arr])[0]
+
+
+def imgs_to_tags(image_arrs: list[np.ndarray]) -> list[list]:
+    """
+    Extract tags from multiple images using template matching, or batched OCR for the images that cannot be matched.
+
+    :param image_arrs: The input images as numpy arrays.
+    :return: A list of valid tags found in each image, in the same order as the input images.
+    """
+    # Match the tags regions against the learned templates first, as it is much faster than OCR
+    regions = [crop_tags_region(image_arr) for image_arr in image_arrs]
+    batch_tags = [match_tags(region) for region in regions]
+    pending = [i for i, tags in enumerate(batch_tags) if tags is None]
+
+    if not pending:
+        return batch_tags
+
+    # Perform OCR on the tags region only, as text detection over the whole image dominates the cost
+    if len(pending) == 1:
+        logger.info("Starting OCR process")
+        batch_results = [get_reader().readtext(regions[pending[0]])]
+    else:
+        logger.info(f"Starting batched OCR process for {len(pending)} images")
+
+        # Pad the tags regions to a common size, as EasyOCR requires all images in a batch to have the same shape
+        pending_regions = [regions[i] for i in pending]
+        batch = np.zeros(
+            (
+                len(pending_regions),
+                max(region.shape[0] for region in pending_regions),
+                max(region.shape[1] for region in pending_regions),
+                3
+            ),
+            dtype=np.uint8
+        )
+        for padded_region, region in zip(batch, pending_regions):
+            padded_region[:region.shape[0], :region.shape[1]] = region[:, :, :3]
+
+        # Perform OCR on the tags regions of all images at once
+        batch_results = get_reader().readtext_batched(batch)
+
+    for i, results in zip(pending, batch_results):
+        batch_tags[i] = ocr_results_to_tags(image_arrs[i], results)
+
+    return batch_tags
+
+
 # Example usage (for debugging)
 if __name__ == '__main__':
     from PIL import Image
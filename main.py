@@ -1,24 +1,80 @@
 import asyncio
-import io
 import logging
 import os
 import sys
 from concurrent.futures import ThreadPoolExecutor
 
+import cv2
+import httpx
 import numpy as np
-from PIL import Image
-from telegram import Update
+from telegram import File, Update
 from telegram.constants import ParseMode
 from telegram.error import TimedOut
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
 from telegram.request import HTTPXRequest
 
-from image_ocr import img_to_tags
-from tkfmtools import recruitment_query
+from image_ocr import TAGS_PER_SCREENSHOT, get_reader, imgs_to_tags
+from tkfmtools import close_browser, recruitment_query
 
 # Initialize a logger for this module
 logger = logging.getLogger(__name__)
 
+# Define the maximum number of images and the time window for batching OCR requests
+OCR_BATCH_SIZE = 4
+OCR_BATCH_WINDOW = 0.05  # 50 milliseconds
+
+# Define the number of parallel ranged requests and the minimum file size for splitting a download
+DOWNLOAD_PARTS = 4
+DOWNLOAD_SPLIT_THRESHOLD = 1024 * 1024  # 1 MiB
+
+# Initialize a shared HTTP client for downloading files in parts
+http_client = httpx.AsyncClient(timeout=60)  # 60 seconds
+
+# Initialize a shared thread pool for running blocking synchronous functions inside asynchronous functions
+executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Initialize the queue of images waiting for OCR, paired with the futures receiving their tags
+ocr_queue: asyncio.Queue[tuple[np.ndarray, asyncio.Future]] = asyncio.Queue()
+
+
+async def download_file(file: File) -> bytearray:
+    """
+    Download a Telegram file, splitting large files into parallel ranged requests.
+    Falls back to the full response or a sequential download if the server does not support ranged requests.
+    """
+    # Download small files, and files served from a local path, sequentially
+    if (file.file_size or 0) < DOWNLOAD_SPLIT_THRESHOLD or not file.file_path.startswith('https://'):
+        return await file.download_as_bytearray()
+
+    # Request all parts of the file at once
+    bounds = [file.file_size * i // DOWNLOAD_PARTS for i in range(DOWNLOAD_PARTS + 1)]
+    try:
+        responses = await asyncio.gather(*(
+            http_client.get(file.file_path, headers={'Range': f'bytes={start_byte}-{end_byte - 1}'})
+            for start_byte, end_byte in zip(bounds, bounds[1:])
+        ))
+    except httpx.HTTPError as e:
+        logger.warning(f"An exception caught while downloading the file in parts: {e}")
+        return await file.download_as_bytearray()
+
+    # Use the whole file directly if the server ignored the ranges and returned it in full
+    for response in responses:
+        if response.status_code == 200 and len(response.content) == file.file_size:
+            logger.info("Ranged requests are not supported, using the full response")
+            return bytearray(response.content)
+
+    # Verify that every part covers exactly its range, as a corrupt image cannot be decoded
+    for response, start_byte, end_byte in zip(responses, bounds, bounds[1:]):
+        if (
+            response.status_code != 206
+            or not response.headers.get('Content-Range', '').startswith(f'bytes {start_byte}-{end_byte - 1}/')
+            or len(response.content) != end_byte - start_byte
+        ):
+            logger.info("Unexpected response to a ranged request, downloading the file sequentially")
+            return await file.download_as_bytearray()
+
+    return bytearray(b''.join(response.content for response in responses))
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -72,22 +128,22 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Download the image
     image_file = await update.message.photo[-1].get_file()  # Get the highest resolution version
-    image_bytearray = await image_file.download_as_bytearray()
+    image_bytearray = await download_file(image_file)
 
     # Update status (2/4)
     await overwrite_message_text(reply_message, r"🔍 *正在提取圖片中的文字\.\.\.* _\(2/4\)_")
 
-    # Convert the image to a NumPy array
-    pil_image = Image.open(io.BytesIO(image_bytearray))
-    image_np = np.array(pil_image)
+    # Decode the image directly into a NumPy array, then convert it from BGR to RGB in place
+    image_np = cv2.imdecode(np.frombuffer(image_bytearray, np.uint8), cv2.IMREAD_COLOR)
+    cv2.cvtColor(image_np, cv2.COLOR_BGR2RGB, dst=image_np)
 
-    # Extract tags using OCR
+    # Extract tags using OCR, batched together with other pending images
     loop = asyncio.get_running_loop()
-    with ThreadPoolExecutor(max_workers=1) as pool:
-        # Run a blocking synchronous function inside an asynchronous function
-        extracted_tags = await loop.run_in_executor(pool, lambda: img_to_tags(image_np))
+    ocr_future = loop.create_future()
+    await ocr_queue.put((image_np, ocr_future))
+    extracted_tags = await ocr_future
 
-    if len(extracted_tags) != 5:
+    if len(extracted_tags) != TAGS_PER_SCREENSHOT:
         # Handle extraction exception
         await overwrite_message_text(reply_message, "❌ *抱歉，無法從圖片中提取文字。請嘗試其他圖片。*")
         return
@@ -96,9 +152,7 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await overwrite_message_text(reply_message, r"📜 *正在篩選可行的標籤組合\.\.\.* _\(3/4\)_")
 
     # Perform recruitment query
-    with ThreadPoolExecutor(max_workers=1) as pool:
-        # Run a blocking synchronous function inside an asynchronous function
-        pdf_bytes_io = await loop.run_in_executor(pool, lambda: recruitment_query(extracted_tags))
+    pdf_bytes_io = await recruitment_query(extracted_tags, executor)
 
     if pdf_bytes_io is None:
         # Handle query exception
@@ -145,10 +199,89 @@ async def handle_non_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f'Sent reply message in chat {update.effective_chat.id} with text: "{reply_message.text}"')
 
 
+async def ocr_batch_worker():
+    """
+    Collect pending images from the OCR queue into batches and extract their tags.
+    """
+    loop = asyncio.get_running_loop()
+
+    while True:
+        # Wait for the first image, then collect more images arriving within the batching window
+        batch = [await ocr_queue.get()]
+        deadline = loop.time() + OCR_BATCH_WINDOW
+        while len(batch) < OCR_BATCH_SIZE and (timeout := deadline - loop.time()) > 0:
+            try:
+                batch.append(await asyncio.wait_for(ocr_queue.get(), timeout))
+            except TimeoutError:
+                break
+
+        image_nps, ocr_futures = zip(*batch)
+        logger.info(f"Processing a batch of {len(batch)} images")
+
+        try:
+            batch_tags = await loop.run_in_executor(executor, imgs_to_tags, list(image_nps))
+        except Exception as e:
+            logger.error(f"An exception caught while processing a batch of images: {e}")
+            if len(batch) == 1:
+                if not ocr_futures[0].done():
+                    ocr_futures[0].set_exception(e)
+                continue
+
+            # Process the images one at a time, so that only the images that actually fail receive the exception
+            for image_np, ocr_future in batch:
+                try:
+                    tags = (await loop.run_in_executor(executor, imgs_to_tags, [image_np]))[0]
+                except Exception as e:
+                    logger.error(f"An exception caught while processing an image: {e}")
+                    if not ocr_future.done():
+                        ocr_future.set_exception(e)
+                else:
+                    if not ocr_future.done():
+                        ocr_future.set_result(tags)
+        else:
+            for ocr_future, tags in zip(ocr_futures, batch_tags):
+                if not ocr_future.done():
+                    ocr_future.set_result(tags)
+
+
+async def post_init(application: Application):
+    # Start the worker that performs OCR on the queued images
+    application.bot_data['ocr_batch_worker'] = asyncio.create_task(ocr_batch_worker())
+
+    # Load the OCR model in the background, so polling starts immediately and the first image rarely waits for it
+    def log_warm_up_exception(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"An exception caught while loading the OCR model: {future.exception()}")
+
+    warm_up_future = asyncio.get_running_loop().run_in_executor(executor, get_reader)
+    warm_up_future.add_done_callback(log_warm_up_exception)
+    application.bot_data['ocr_warm_up'] = warm_up_future
+
+
+async def post_shutdown(application: Application):
+    # Stop the worker that performs OCR on the queued images
+    ocr_batch_worker_task = application.bot_data['ocr_batch_worker']
+    ocr_batch_worker_task.cancel()
+    try:
+        await ocr_batch_worker_task
+    except asyncio.CancelledError:
+        pass
+
+    # Close the browser kept open for recruitment queries
+    await close_browser()
+
+    # Close the HTTP client used for downloading files
+    await http_client.aclose()
+
+
 def main(token: str):
     # Build the application
     request = HTTPXRequest(connection_pool_size=20, read_timeout=60)  # 60 seconds
-    application = ApplicationBuilder().token(token).request(request).build()
+    application = (
+        ApplicationBuilder().token(token).request(request)
+        .post_init(post_init).post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Register the /start command handler
     application.add_handler(CommandHandler('start', start))
@@ -1,101 +1,214 @@
+import asyncio
 import io
 import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor
 
 from PIL import Image
-from playwright.sync_api import TimeoutError as PlaywrightTimeoutError, sync_playwright
+from playwright.async_api import Browser, Playwright, TimeoutError as PlaywrightTimeoutError, async_playwright
 
 # Initialize a logger for this module
 logger = logging.getLogger(__name__)
 
+# Define how long query results are cached, as the data of the TenkafuMA Toolbox may be updated
+QUERY_CACHE_TTL = 24 * 60 * 60  # 1 day
 
-def recruitment_query(tags: list) -> io.BytesIO | None:
+# Define the maximum total size of cached query results
+QUERY_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 32 MiB
+
+# Define the initial viewport size, which is extended to fit the result table before taking the screenshot
+VIEWPORT = {'width': 2160, 'height': 1080}
+
+# The browser is launched lazily and kept open across queries
+_playwright: Playwright | None = None
+_browser: Browser | None = None
+_browser_lock = asyncio.Lock()
+
+# Cache the PDF file content of query results, keyed by sorted tags and cache period, in least recently used order
+_query_cache: OrderedDict[tuple[tuple, int], bytes] = OrderedDict()
+
+
+async def recruitment_query(tags: list, executor: Executor | None = None) -> io.BytesIO | None:
     """
     Performs a recruitment query using the specified tags and returns the results as a PDF.
 
     :param tags: A list of tags to apply in the query.
+    :param executor: The executor that runs blocking work, or None to use the event loop's default executor.
     :return: A BytesIO object containing the PDF file if the query is successful, or None if a timeout occurs.
     """
     logger.info(f"Starting recruitment query with tags: {tags}")
 
-    with sync_playwright() as p:
-        # Launch the browser
-        logger.debug("Launching browser")
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(viewport={'width': 2160, 'height': 17280})  # 1:8 aspect ratio
-        page = context.new_page()
-
-        # Set default timeout
-        page.set_default_timeout(10000)  # 10 seconds
+    # Sort the tags so that the same tags in a different order share the cached result
+    cache_key = (tuple(sorted(tags)), int(time.time() // QUERY_CACHE_TTL))
 
+    pdf_bytes = _query_cache.get(cache_key)
+    if pdf_bytes is None:
         try:
-            # Navigate to the TenkafuMA Toolbox
-            logger.debug("Navigating to TenkafuMA Toolbox")
-            page.goto("https://purindaisuki.github.io/tkfmtools/enlist/filter/")
+            pdf_bytes = await _run_query(cache_key[0], executor)
+        except PlaywrightTimeoutError:
+            logger.error("Timeout occurred during the recruitment query")
+            return None  # Timeouts are not cached
+
+        # Drop the results of past cache periods, as they can no longer be used
+        for key in [key for key in _query_cache if key[1] != cache_key[1]]:
+            del _query_cache[key]
+
+        # Cache the result, evicting the least recently used ones while the cache is too large
+        _query_cache[cache_key] = pdf_bytes
+        cache_bytes = sum(len(cached_pdf_bytes) for cached_pdf_bytes in _query_cache.values())
+        while cache_bytes > QUERY_CACHE_MAX_BYTES:
+            _, evicted_pdf_bytes = _query_cache.popitem(last=False)
+            cache_bytes -= len(evicted_pdf_bytes)
+    else:
+        logger.info("Using cached recruitment query result")
+        _query_cache.move_to_end(cache_key)
+
+    # Wrap the result in a new BytesIO object, so that concurrent consumers do not share a seek position
+    return io.BytesIO(pdf_bytes)
+
+
+async def _get_browser() -> Browser:
+    """
+    Return the shared browser, launching it on the first call or after it has been disconnected.
 
-            # Wait until the page is fully loaded (i.e., all 7 tag categories are present)
-            logger.debug("Waiting for the page to load completely")
-            page.wait_for_function("['屬性', '定位', '種族', '體型', 'ㄋㄋ', '階級', '其他']"
-                                   ".every(word => document.body.innerText.includes(word));")
+    :return: The shared browser instance.
+    """
+    global _playwright, _browser
 
-            # Open the settings menu
-            logger.debug("Opening settings menu")
-            page.get_by_label('顯示設定').click()
+    async with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            logger.info("Launching browser")
+            if _playwright is None:
+                _playwright = await async_playwright().start()
+            _browser = await _playwright.chromium.launch(headless=True)
 
-            # Change the result display format
-            logger.debug("Changing result display format to '依標籤組合'")
-            page.get_by_label('依標籤組合').click()
+        return _browser
 
-            # Close the settings menu
-            logger.debug("Closing the settings menu")
-            page.get_by_text('×').click()
 
-            # Click on each tag in the `tags` list
-            for tag in tags:
-                logger.debug(f"Selecting tag: {tag}")
-                page.get_by_text(tag).click()
+async def close_browser():
+    """
+    Close the shared browser and stop Playwright if they have been started, e.g., when the bot shuts down.
+    """
+    global _playwright, _browser
 
-            # Wait for all images to load completely
-            logger.debug("Waiting for all images to load completely")
-            page.wait_for_function("Array.from(document.getElementsByTagName('img')).every(img => img.complete);")
+    async with _browser_lock:
+        if _browser is not None:
+            logger.info("Closing browser")
+            await _browser.close()
+            _browser = None
 
-            # Capture the result as image bytes
-            logger.debug("Capturing the result as an image")
-            screenshot_bytes = page.locator('table').screenshot()
+        if _playwright is not None:
+            await _playwright.stop()
+            _playwright = None
 
-            # Convert bytes to a PIL image
-            logger.debug("Converting screenshot bytes to a PIL image")
-            pil_image = Image.open(io.BytesIO(screenshot_bytes))
 
-            # Convert to 'RGB' for consistency across platforms (Windows: 'RGBA', macOS: 'RGB')
-            pil_image = pil_image.convert('RGB')
+async def _run_query(tags: tuple, executor: Executor | None) -> bytes:
+    """
+    Performs a recruitment query on the TenkafuMA Toolbox using the shared browser and returns the PDF file content.
 
-            # Save the PIL image as a PDF in a BytesIO object
-            logger.debug("Saving the PIL image as a PDF")
-            pdf_bytes_io = io.BytesIO()
-            pil_image.save(pdf_bytes_io, 'PDF', quality=100)
+    :param tags: A tuple of tags to apply in the query.
+    :param executor: The executor that builds the PDF, or None to use the event loop's default executor.
+    :return: The PDF file content.
+    :raises PlaywrightTimeoutError: If a timeout occurs during the query.
+    """
+    # Open a new context in the shared browser
+    logger.debug("Opening a new browser context")
+    context = await (await _get_browser()).new_context(viewport=VIEWPORT, device_scale_factor=1)
+    page = await context.new_page()
+
+    # Set default timeout
+    page.set_default_timeout(10000)  # 10 seconds
+
+    try:
+        # Navigate to the TenkafuMA Toolbox
+        logger.debug("Navigating to TenkafuMA Toolbox")
+        await page.goto("https://purindaisuki.github.io/tkfmtools/enlist/filter/")
+
+        # Wait until the page is fully loaded (i.e., all 7 tag categories are present)
+        logger.debug("Waiting for the page to load completely")
+        await page.wait_for_function("['屬性', '定位', '種族', '體型', 'ㄋㄋ', '階級', '其他']"
+                                     ".every(word => document.body.innerText.includes(word));")
+
+        # Open the settings menu
+        logger.debug("Opening settings menu")
+        await page.get_by_label('顯示設定').click()
+
+        # Change the result display format
+        logger.debug("Changing result display format to '依標籤組合'")
+        await page.get_by_label('依標籤組合').click()
+
+        # Close the settings menu
+        logger.debug("Closing the settings menu")
+        await page.get_by_text('×').click()
+
+        # Click on each tag in the `tags` list
+        for tag in tags:
+            logger.debug(f"Selecting tag: {tag}")
+            await page.get_by_text(tag).click()
+
+        # Extend the viewport to the full page height, so that all images in the result table are loaded
+        page_height = await page.evaluate("document.documentElement.scrollHeight")
+        if page_height > VIEWPORT['height']:
+            logger.debug(f"Extending viewport height to {page_height}")
+            await page.set_viewport_size({'width': VIEWPORT['width'], 'height': page_height})
+
+        # Wait for all images to load completely
+        logger.debug("Waiting for all images to load completely")
+        await page.wait_for_function(
+            "Array.from(document.getElementsByTagName('img')).every(img => img.complete);"
+        )
+
+        # Capture the result as image bytes
+        logger.debug("Capturing the result as an image")
+        screenshot_bytes = await page.locator('table').screenshot()
+
+        # Build the PDF in the given executor, so that the event loop is not blocked
+        pdf_bytes = await asyncio.get_running_loop().run_in_executor(executor, _image_to_pdf, screenshot_bytes)
+
+        logger.info("Recruitment query completed successfully")
+        return pdf_bytes
+
+    finally:
+        # Ensure resources are closed properly, keeping the browser open for subsequent queries
+        logger.debug("Closing page and context")
+        await page.close()
+        await context.close()
+
+
+def _image_to_pdf(image_bytes: bytes) -> bytes:
+    """
+    Save an image as a single-page PDF.
 
-            # Reset the seek position to the beginning of the BytesIO object
-            pdf_bytes_io.seek(0)
+    :param image_bytes: The content of the image file.
+    :return: The PDF file content.
+    """
+    # Convert bytes to a PIL image
+    logger.debug("Converting screenshot bytes to a PIL image")
+    pil_image = Image.open(io.BytesIO(image_bytes))
 
-            logger.info("Recruitment query completed successfully")
-            return pdf_bytes_io
+    # Convert to 'RGB' for consistency across platforms (Windows: 'RGBA', macOS: 'RGB')
+    pil_image = pil_image.convert('RGB')
 
-        except PlaywrightTimeoutError:
-            logger.error("Timeout occurred during the recruitment query")
-            return None
+    # Save the PIL image as a PDF in a BytesIO object
+    # JPEG at quality 100 keeps the file smaller than embedding the lossless screenshot pixels
+    logger.debug("Saving the PIL image as a PDF")
+    pdf_bytes_io = io.BytesIO()
+    pil_image.save(pdf_bytes_io, 'PDF', quality=100)
 
-        finally:
-            # Ensure resources are closed properly
-            logger.debug("Closing page, context, and browser")
-            page.close()
-            context.close()
-            browser.close()
+    return pdf_bytes_io.getvalue()
 
 
 # Example usage (for debugging)
 if __name__ == '__main__':
+    async def debug_query(tags: list) -> io.BytesIO | None:
+        try:
+            return await recruitment_query(tags)
+        finally:
+            await close_browser()
+
     example_tags = ['中體型', '風屬性', '士兵', '亞人', '防禦']
-    result = recruitment_query(example_tags)
+    result = asyncio.run(debug_query(example_tags))
 
     if result:
         # Save the result to a PDF file